@@ -2,17 +2,18 @@
 # Autor: Manuel Morales (manuel.moraleschaves@ucr.ac.cr)
 # Fecha de creación: 2022-02-15
 
-import math
+import hashlib
+from io import BytesIO
 
 import streamlit as st
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 import plotly.express as px
 
 import folium
-from folium import Marker
 from folium.plugins import MarkerCluster
 from folium.plugins import HeatMap
 from streamlit_folium import folium_static
@@ -23,6 +24,122 @@ from streamlit_folium import folium_static
 st.set_page_config(layout="wide")
 
 
+#
+# FUNCIONES DE CARGA DE DATOS
+#
+
+# Columnas del archivo DwC utilizadas en la aplicación y sus tipos de datos
+COLUMNAS_REGISTROS_PRESENCIA = ['species', 'family', 'eventDate', 'locality', 'occurrenceID', 
+                                'decimalLongitude', 'decimalLatitude']
+# (las coordenadas en float32 conservan una precisión cercana a 1 m, suficiente para los registros de presencia)
+TIPOS_REGISTROS_PRESENCIA = {'decimalLongitude':'float32', 
+                             'decimalLatitude':'float32', 
+                             'species':'string[pyarrow]', 
+                             'family':'string[pyarrow]', 
+                             'locality':'string[pyarrow]', 
+                             'occurrenceID':'string[pyarrow]'}
+
+# Cantidad de filas leídas en cada fragmento del archivo y máxima cantidad de registros de presencia que se cargan
+TAMANO_FRAGMENTO = 200_000
+MAXIMO_REGISTROS_PRESENCIA = 2_000_000
+
+# Carga y limpieza de registros de presencia
+# El resultado se guarda en caché, por lo que cada archivo se procesa una sola vez
+# (el caché es compartido por todas las sesiones, por lo que solo se conservan los archivos más recientes)
+# Devuelve también si la lectura se detuvo antes del final del archivo y la huella del archivo,
+# que se usa como llave de los cálculos en caché por especie
+@st.cache_data(show_spinner=False, max_entries=2)
+def cargar_registros_presencia(contenido_archivo):
+    # Carga de registros de presencia en un dataframe
+    # El archivo se lee por fragmentos (solo con las columnas necesarias), que se limpian conforme se leen,
+    # y la lectura se detiene al alcanzar la máxima cantidad de registros
+    fragmentos = []
+    cantidad_registros = 0
+    truncado = False
+    for fragmento in pd.read_csv(BytesIO(contenido_archivo), 
+                                 sep='\t', 
+                                 usecols=COLUMNAS_REGISTROS_PRESENCIA, 
+                                 dtype=TIPOS_REGISTROS_PRESENCIA, 
+                                 chunksize=TAMANO_FRAGMENTO):
+        # Limpieza de datos
+        # Cambio del tipo de datos del campo de fecha (formato ISO 8601 del DwC, sin inferencia por registro)
+        # Las fechas se llevan a UTC y luego se les quita la zona horaria, para que fechas con y sin zona
+        # horaria produzcan siempre el mismo tipo de datos en todos los fragmentos
+        fragmento["eventDate"] = pd.to_datetime(fragmento["eventDate"], format='ISO8601', errors='coerce', cache=True, utc=True).dt.tz_localize(None)
+        # Eliminación de registros con valores nulos en la columna 'species' o con fechas vacías o inválidas
+        fragmento = fragmento.dropna(subset=['species', 'eventDate'])
+
+        # Si el fragmento sobrepasa la máxima cantidad de registros, se toma solo la parte que cabe y se detiene la lectura
+        if cantidad_registros + len(fragmento) > MAXIMO_REGISTROS_PRESENCIA:
+            fragmentos.append(fragmento.head(MAXIMO_REGISTROS_PRESENCIA - cantidad_registros))
+            truncado = True
+            break
+        fragmentos.append(fragmento)
+        cantidad_registros += len(fragmento)
+    registros_presencia = pd.concat(fragmentos, ignore_index=True)
+
+    # Especie como variable categórica (el filtrado compara códigos enteros en lugar de textos)
+    # Las categorías se crean ordenadas, para usarlas directamente como lista de especies
+    registros_presencia['species'] = pd.Categorical(registros_presencia['species'], 
+                                                    categories=sorted(registros_presencia['species'].unique()))
+    # Año y mes de cada registro, precalculados como enteros pequeños
+    registros_presencia['anio'] = registros_presencia['eventDate'].dt.year.astype('int16')
+    registros_presencia['mes'] = registros_presencia['eventDate'].dt.month.astype('int8')
+
+    # Huella del archivo (se calcula solo una vez, junto con la carga)
+    huella_archivo = hashlib.md5(contenido_archivo, usedforsecurity=False).hexdigest()
+
+    return registros_presencia, truncado, huella_archivo
+
+# Carga de polígonos de ASP
+# Se descarga una sola vez y se comparte entre todas las ejecuciones de la aplicación
+@st.cache_resource(show_spinner=False)
+def cargar_asp():
+    asp = gpd.read_file("https://github.com/pf3311-cienciadatosgeoespaciales/2021-iii/raw/main/contenido/b/datos/asp.geojson")
+    # Construcción anticipada del índice espacial, para que quede también en caché
+    _ = asp.sindex
+    return asp
+
+
+#
+# FUNCIONES DE PROCESAMIENTO
+#
+
+# Los resultados se guardan en caché usando como llave la huella del archivo y la especie
+# (los parámetros cuyo nombre inicia con '_' no forman parte de la llave)
+# Se conservan solo las combinaciones de archivo y especie más recientes
+
+# Conteo de registros de presencia por año
+@st.cache_data(show_spinner=False, max_entries=20)
+def contar_registros_por_anio(huella_archivo, especie, _registros_especie):
+    registros_presencia_grp_anio = _registros_especie['anio'].value_counts().sort_index()
+    return registros_presencia_grp_anio.rename_axis('anio').to_frame('registros_presencia')
+
+# Conteo de registros de presencia por mes
+@st.cache_data(show_spinner=False, max_entries=20)
+def contar_registros_por_mes(huella_archivo, especie, _registros_especie):
+    registros_presencia_grp_mes = _registros_especie['mes'].value_counts().sort_index()
+    return registros_presencia_grp_mes.rename_axis('mes').to_frame('registros_presencia')
+
+# Conteo de registros de presencia en cada ASP
+@st.cache_data(show_spinner=False, max_entries=20)
+def contar_registros_en_asp(huella_archivo, especie, _registros_especie):
+    asp = cargar_asp()
+    # Consulta espacial de los registros de presencia contenidos en cada ASP, con el índice espacial de las ASP
+    # (devuelve pares de índices punto-polígono, sin construir un dataframe intermedio)
+    # Las geometrías se construyen solo para los registros de la especie seleccionada que tienen coordenadas
+    # (la consulta solo devuelve los pares que coinciden; las ASP sin registros quedan en 0 con minlength)
+    registros_con_coordenadas = _registros_especie[['decimalLongitude', 'decimalLatitude']].dropna()
+    geometrias_registros = gpd.points_from_xy(registros_con_coordenadas.decimalLongitude, 
+                                              registros_con_coordenadas.decimalLatitude,
+                                              crs='EPSG:4326')
+    indices_registros, indices_asp = asp.sindex.query(geometrias_registros, predicate='within')
+    # El dataframe sigue el mismo orden de filas que la capa de ASP, por lo que el nombre se toma directamente
+    return pd.DataFrame({'id': asp['id'].values, 
+                         'nombre_asp': asp['nombre_asp'].values, 
+                         'cantidad_registros_presencia': np.bincount(indices_asp, minlength=len(asp))})
+
+
 #
 # TÍTULO Y DESCRIPCIÓN DE LA APLICACIÓN
 #
@@ -43,29 +160,18 @@ archivo_registros_presencia = st.sidebar.file_uploader('Seleccione un archivo CS
 
 # Se continúa con el procesamiento solo si hay un archivo de datos cargado
 if archivo_registros_presencia is not None:
-    # Carga de registros de presencia en un dataframe
-    registros_presencia = pd.read_csv(archivo_registros_presencia, delimiter='\t')
-    # Conversión del dataframe de registros de presencia a geodataframe
-    registros_presencia = gpd.GeoDataFrame(registros_presencia, 
-                                           geometry=gpd.points_from_xy(registros_presencia.decimalLongitude, 
-                                                                       registros_presencia.decimalLatitude),
-                                           crs='EPSG:4326')
-
-    # Carga de polígonos de ASP
-    asp = gpd.read_file("https://github.com/pf3311-cienciadatosgeoespaciales/2021-iii/raw/main/contenido/b/datos/asp.geojson")
-
+    # Carga y limpieza de registros de presencia, y huella del archivo (desde caché)
+    registros_presencia, truncado, huella_archivo = cargar_registros_presencia(archivo_registros_presencia.getvalue())
+    if truncado:
+        st.sidebar.warning(f'Solo se cargaron los primeros {MAXIMO_REGISTROS_PRESENCIA:,} registros de presencia del archivo.')
 
-    # Limpieza de datos
-    # Eliminación de registros con valores nulos en la columna 'species'
-    registros_presencia = registros_presencia[registros_presencia['species'].notna()]
-    # Cambio del tipo de datos del campo de fecha
-    registros_presencia["eventDate"] = pd.to_datetime(registros_presencia["eventDate"])
+    # Carga de polígonos de ASP (desde caché)
+    asp = cargar_asp()
 
     # Especificación de filtros
     #st.header('Filtros de datos')
     # Especie
-    lista_especies = registros_presencia.species.unique().tolist()
-    lista_especies.sort()
+    lista_especies = registros_presencia['species'].cat.categories.tolist()
     filtro_especie = st.sidebar.selectbox('Seleccione la especie', lista_especies)
 
 
@@ -75,13 +181,13 @@ if archivo_registros_presencia is not None:
 
     # Filtrado
     registros_presencia = registros_presencia[registros_presencia['species'] == filtro_especie]
+    # Si no hay registros para la especie seleccionada, no se realiza el resto del procesamiento
+    if registros_presencia.empty:
+        st.info('Sin registros para la especie seleccionada')
+        st.stop()
 
-    # Cálculo de la cantidad de registros en ASP
-    # "Join" espacial de las capas de ASP y registros de presencia
-    asp_contienen_registros = asp.sjoin(registros_presencia, how="left", predicate="contains")
-    # Conteo de registros de presencia en cada ASP
-    asp_registros = asp_contienen_registros.groupby("id").agg(cantidad_registros_presencia = ("gbifID","count"))
-    asp_registros = asp_registros.reset_index() # para convertir la serie a dataframe
+    # Cálculo de la cantidad de registros en ASP (desde caché)
+    asp_registros = contar_registros_en_asp(huella_archivo, filtro_especie, registros_presencia)
 
 
     #
@@ -90,7 +196,6 @@ if archivo_registros_presencia is not None:
 
     # Tabla de registros de presencia
     st.header('Registros de presencia')
-    #st.subheader('st.dataframe()')
     st.dataframe(registros_presencia[['family', 'species', 'eventDate', 'locality', 'occurrenceID']].rename(columns = {'family':'Familia', 'species':'Especie', 'eventDate':'Fecha', 'locality':'Localidad', 'occurrenceID':'Origen del dato'}))
 
     # Definición de columnas
@@ -99,52 +204,37 @@ if archivo_registros_presencia is not None:
     with col1:
         # Gráficos de historial de registros de presencia por año
         st.header('Historial de registros por año')
-        registros_presencia_grp_anio = pd.DataFrame(registros_presencia.groupby(registros_presencia['eventDate'].dt.year).count().eventDate)
-        registros_presencia_grp_anio.columns = ['registros_presencia']
-        # streamlit
-        #st.subheader('st.bar_chart()')
-        #st.bar_chart(registros_presencia_grp_anio)
-        # plotly
-        #st.subheader('px.bar()')
+        registros_presencia_grp_anio = contar_registros_por_anio(huella_archivo, filtro_especie, registros_presencia)
         fig = px.bar(registros_presencia_grp_anio, 
-                     labels={'eventDate':'Año', 'value':'Registros de presencia'})
+                     labels={'anio':'Año', 'value':'Registros de presencia'})
         st.plotly_chart(fig)
 
     with col2:
         # Gráficos de estacionalidad de registros de presencia por mes
         st.header('Estacionalidad de registros por mes')
-        registros_presencia_grp_mes = pd.DataFrame(registros_presencia.groupby(registros_presencia['eventDate'].dt.month).count().eventDate)
-        registros_presencia_grp_mes.columns = ['registros_presencia']
-        # streamlit
-        #st.subheader('st.area_chart()')
-        #st.area_chart(registros_presencia_grp_mes)
-        # plotly
-        #st.subheader('px.area()')
+        registros_presencia_grp_mes = contar_registros_por_mes(huella_archivo, filtro_especie, registros_presencia)
         fig = px.area(registros_presencia_grp_mes, 
-                     labels={'eventDate':'Mes', 'value':'Registros de presencia'})
+                     labels={'mes':'Mes', 'value':'Registros de presencia'})
         st.plotly_chart(fig)      
 
     with col1:
         # Gráficos de cantidad de registros de presencia por ASP
-        # "Join" para agregar la columna con el conteo a la capa de ASP
-        asp_registros = asp_registros.join(asp.set_index('id'), on='id', rsuffix='_b')
         # Dataframe filtrado para usar en graficación
         asp_registros_grafico = asp_registros.loc[asp_registros['cantidad_registros_presencia'] > 0, 
-                                                                ["nombre_asp", "cantidad_registros_presencia"]].sort_values("cantidad_registros_presencia", ascending=[False]).head(15)
+                                                                ["nombre_asp", "cantidad_registros_presencia"]]
+        # Selección de las 15 ASP con más registros mediante partición (solo esas 15 se ordenan)
+        if len(asp_registros_grafico) > 15:
+            indices_top = np.argpartition(-asp_registros_grafico['cantidad_registros_presencia'].values, 14)[:15]
+            asp_registros_grafico = asp_registros_grafico.iloc[indices_top]
+        asp_registros_grafico = asp_registros_grafico.sort_values("cantidad_registros_presencia", ascending=[False])
         asp_registros_grafico = asp_registros_grafico.set_index('nombre_asp')  
         # st.write(asp_registros_grafico) para debug                                                       
         st.header('Cantidad de registros por ASP')
-        # streamlit
-        #st.subheader('st.bar_chart()')
-        #st.bar_chart(asp_registros_grafico)    
-        # plotly
-        #st.subheader('px.bar()')
         fig = px.bar(asp_registros_grafico, 
                      labels={'nombre_asp':'ASP', 'cantidad_registros_presencia':'Registros de presencia'})
         st.plotly_chart(fig)  
 
     with col2:
-        #st.subheader('px.pie()')
         st.header('Porcentaje de registros por ASP')
         fig = px.pie(asp_registros_grafico, 
                      names=asp_registros_grafico.index,
@@ -154,26 +244,27 @@ if archivo_registros_presencia is not None:
 
     # Mapa de registros de presencia
     st.header('Mapa de registros de presencia')
-    #st.subheader('st.map()')
-    st.map(registros_presencia.rename(columns = {'decimalLongitude':'longitude', 'decimalLatitude':'latitude'}))
+    # (solo se envían al navegador las columnas de coordenadas)
+    st.map(registros_presencia[['decimalLatitude', 'decimalLongitude']].rename(columns = {'decimalLongitude':'longitude', 'decimalLatitude':'latitude'}))
 
     with col1:
         # Mapa de calor y de registros agrupados
         st.header('Mapa de calor y de registros agrupados')
-        #st.subheader('folium.plugins.HeatMap(), folium.plugins.MarkerCluster()')    
         # Capa base
         m = folium.Map(location=[9.6, -84.2], tiles='CartoDB dark_matter', zoom_start=8)
+        # Coordenadas válidas de los registros de presencia, como arreglo de pares [latitud, longitud]
+        coordenadas = np.column_stack([registros_presencia['decimalLatitude'].values, 
+                                       registros_presencia['decimalLongitude'].values])
+        coordenadas = coordenadas[~np.isnan(coordenadas).any(axis=1)].tolist()
         # Capa de calor
-        HeatMap(data=registros_presencia[['decimalLatitude', 'decimalLongitude']],
+        HeatMap(data=coordenadas,
                 name='Mapa de calor').add_to(m)
         # Capa de ASP
         folium.GeoJson(data=asp, name='ASP').add_to(m)
-        # Capa de registros de presencia agrupados
-        mc = MarkerCluster(name='Registros agrupados')
-        for idx, row in registros_presencia.iterrows():
-            if not math.isnan(row['decimalLongitude']) and not math.isnan(row['decimalLatitude']):
-                mc.add_child(Marker([row['decimalLatitude'], row['decimalLongitude']], 
-                                    popup=row['species']))
+        # Capa de registros de presencia agrupados (todos los marcadores se crean en una sola llamada)
+        mc = MarkerCluster(locations=coordenadas,
+                           popups=[filtro_especie] * len(coordenadas),
+                           name='Registros agrupados')
         m.add_child(mc)
         # Control de capas
         folium.LayerControl().add_to(m)    
@@ -183,7 +274,6 @@ if archivo_registros_presencia is not None:
     with col2:
         # Mapa de coropletas de registros de presencia en ASP
         st.header('Mapa de cantidad de registros de presencia en ASP')
-        #st.subheader('folium.Choropleth()')    
         # Capa base
         m = folium.Map(location=[9.6, -84.2], tiles='CartoDB positron', zoom_start=8)
         # Capa de coropletas